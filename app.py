@@ -1,10 +1,25 @@
+import os
+
+# Must be set before torch/onnxruntime create their thread pools.
+os.environ.setdefault("OMP_NUM_THREADS", str(max(1, (os.cpu_count() or 2) // 2)))
+NUM_THREADS = int(os.environ["OMP_NUM_THREADS"])
+os.environ.setdefault("MKL_NUM_THREADS", str(NUM_THREADS))
+os.environ.setdefault("KMP_AFFINITY", "granularity=fine,compact,1,0")
+os.environ.setdefault("KMP_BLOCKTIME", "0")
+
 import streamlit as st
-from transformers import GPT2LMHeadModel, GPT2Tokenizer, pipeline
-import torch
 import re  
-import os
-import subprocess
-import json
+import html
+import shutil
+import contextlib
+import queue
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+from collections import OrderedDict
+from threading import Lock, Thread
+
+from fetch_model import MODEL_PATH, fetch_model, model_present
 
 st.set_page_config(
     page_title="Recipe Generator",
@@ -13,90 +28,565 @@ st.set_page_config(
     initial_sidebar_state="auto"
 )
 
-MODEL_PATH = "final_model"
+ONNX_PATH = "final_model_onnx"
+ONNX_FILE = "model_optimized.onnx"
+ONNX_INT8_FILE = "model_optimized_int8_pc.onnx"
+CT2_PATH = "final_model_ct2"
+MAX_BATCH_SIZE = 8
+MAX_BATCH_WAIT = 0.025
+RECIPE_CACHE_SIZE = 256
+GREEDY_MAX_TEMPERATURE = 0.3
+STEP_RE = re.compile(r' (\d+\.)')
+RECIPE_HTML = "<p>{body}</p>"
+# "onnx", "ctranslate2" or "torch"; the first two fall back to PyTorch if they fail to load.
+BACKEND = os.environ.get("RECIPE_BACKEND", "onnx")
+
+os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath("final_model_inductor_cache"))
+os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
 
 @st.cache_resource
 def setup_and_download_model():
-    if not os.path.exists(MODEL_PATH):
-        print("Model folder not found. Starting download from Kaggle...")
-        
-        if "KAGGLE_USERNAME" not in st.secrets or "KAGGLE_KEY" not in st.secrets:
-            st.error("Kaggle API secrets not found. Please add KAGGLE_USERNAME and KAGGLE_KEY to your Streamlit secrets.")
-            return False
+    if model_present():
+        print("Model folder already exists.")
+        return True
 
-        kaggle_dir = os.path.expanduser("~/.kaggle")
-        os.makedirs(kaggle_dir, exist_ok=True)
-        
-        kaggle_json_path = os.path.join(kaggle_dir, "kaggle.json")
-        api_creds = {
-            "username": st.secrets["KAGGLE_USERNAME"],
-            "key": st.secrets["KAGGLE_KEY"]
-        }
-        
-        with open(kaggle_json_path, "w") as f:
-            json.dump(api_creds, f)
-            
-        try:
-            subprocess.run(["chmod", "600", kaggle_json_path], check=True)
-        except Exception as e:
-            print(f"Warning: Could not set file permissions. {e}")
+    print("Model folder not found. Starting download from Kaggle...")
+    
+    if "KAGGLE_USERNAME" not in st.secrets or "KAGGLE_KEY" not in st.secrets:
+        st.error("Kaggle API secrets not found. Please add KAGGLE_USERNAME and KAGGLE_KEY to your Streamlit secrets.")
+        return False
+
+    try:
+        fetch_model(st.secrets["KAGGLE_USERNAME"], st.secrets["KAGGLE_KEY"])
+        return True
+    except Exception as e:
+        st.error(f"Failed to download model from Kaggle: {e}")
+        return False
+
+model_ready = setup_and_download_model()
+
+WARMUP_PROMPT = "TITLE: garlic chicken pasta\nINGREDIENTS: chicken breast, pasta, garlic, olive oil\nRECIPE:"
+
+def bf16_supported():
+    import torch
+
+    # oneDNN's own check is also true on plain AVX-512, where BF16 is emulated.
+    try:
+        return torch.cpu._is_avx512_bf16_supported() or torch.cpu._is_amx_tile_supported()
+    except AttributeError:
+        return False
+
+def warmup_model(model, tokenizer, runs=3):
+    import torch
+
+    enc = tokenizer(WARMUP_PROMPT, return_tensors="pt").to(model.device)
+    with torch.inference_mode():
+        for _ in range(runs):
+            model.generate(**enc, max_new_tokens=8, do_sample=True, pad_token_id=tokenizer.eos_token_id)
+
+@st.cache_resource(show_spinner=False)
+def prompt_scaffold(_tokenizer):
+    encode = lambda text: _tokenizer.encode(text, add_special_tokens=False)
+    return encode("TITLE:"), encode("\nINGREDIENTS:"), encode("\nRECIPE:")
+
+def encode_prompt(tokenizer, title_clean, ingredients_clean):
+    title_ids, ingredients_ids, recipe_ids = prompt_scaffold(tokenizer)
+    # Split before the leading space so the BPE merges match encoding the whole prompt.
+    return (
+        title_ids
+        + tokenizer.encode(f" {title_clean}", add_special_tokens=False)
+        + ingredients_ids
+        + tokenizer.encode(f" {ingredients_clean}", add_special_tokens=False)
+        + recipe_ids
+    )
+
+class GenerationRequest:
+    def __init__(self, input_ids, seed, gen_kwargs, streamer):
+        self.input_ids = input_ids
+        self.seed = seed
+        self.gen_kwargs = gen_kwargs
+        self.streamer = streamer
+        self.error = None
+        self.cancelled = False
+
+class CancelledRequests:
+    """Stopping criterion that finishes the rows whose sessions stopped reading their stream."""
+
+    def __init__(self, requests):
+        self.requests = requests
+
+    def __call__(self, input_ids, scores, **kwargs):
+        import torch
+
+        return torch.tensor([request.cancelled for request in self.requests], device=input_ids.device)
+
+class BatchStreamer:
+    """Fans the token stream of a batched generate() call out to one streamer per request (duck-types BaseStreamer)."""
+
+    def __init__(self, streamers):
+        self.streamers = streamers
+
+    def put(self, value):
+        rows = value if value.dim() > 1 else value.unsqueeze(1)
+        for streamer, row in zip(self.streamers, rows):
+            streamer.put(row)
+
+    def end(self):
+        for streamer in self.streamers:
+            streamer.end()
+
+class RecipeBatcher:
+    """Collects requests from concurrent sessions for a short window and decodes them in one batch."""
+
+    def __init__(self, model, tokenizer):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.requests = queue.Queue()
+        Thread(target=self.run, daemon=True).start()
+
+    def submit(self, input_ids, seed, **gen_kwargs):
+        from transformers import TextIteratorStreamer
+
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        request = GenerationRequest(input_ids, seed, gen_kwargs, streamer)
+        self.requests.put(request)
+        return request
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + MAX_BATCH_WAIT
+            while len(batch) < MAX_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            groups = {}
+            for request in batch:
+                if request.cancelled:
+                    continue
+                groups.setdefault(tuple(sorted(request.gen_kwargs.items())), []).append(request)
+            for group in groups.values():
+                self.generate(group)
+
+    def generate(self, group):
+        import torch
+        from transformers import StoppingCriteriaList
+
+        pad_id = self.tokenizer.pad_token_id
+        streamer = BatchStreamer([request.streamer for request in group])
 
         try:
-            print("Downloading model from Kaggle...")
-            subprocess.run(
-                [
-                    "kaggle", "datasets", "download",
-                    "ahmadijaz92/genai-p3-t1",
-                    "-p", ".",
-                    "--unzip"
-                ],
-                check=True
-            )
-            print("Model downloaded and unzipped successfully.")
-            return True
-        except subprocess.CalledProcessError as e:
-            st.error(f"Failed to download model from Kaggle: {e}")
-            return False
+            width = max(len(request.input_ids) for request in group)
+            # Left-pad so every row's prompt ends where generation starts.
+            input_ids = torch.tensor([[pad_id] * (width - len(r.input_ids)) + r.input_ids for r in group])
+            attention_mask = torch.tensor([[0] * (width - len(r.input_ids)) + [1] * len(r.input_ids) for r in group])
+
+            # Only a request decoded alone is reproducible; CTranslate2 ignores this seed.
+            torch.manual_seed(zlib.crc32(repr([request.seed for request in group]).encode()))
+            device = getattr(self.model, "device", "cpu")
+            with torch.inference_mode():
+                self.model.generate(
+                    input_ids=input_ids.to(device),
+                    attention_mask=attention_mask.to(device),
+                    streamer=streamer,
+                    stopping_criteria=StoppingCriteriaList([CancelledRequests(group)]),
+                    **group[0].gen_kwargs
+                )
         except Exception as e:
-            st.error(f"An error occurred: {e}")
-            return False
+            for request in group:
+                request.error = e
+            streamer.end()
+
+@st.cache_resource(show_spinner=False)
+def get_batcher(_model, _tokenizer):
+    return RecipeBatcher(_model, _tokenizer)
+
+class RecipeCache:
+    """LRU of finished recipes shared by every session."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, recipe):
+        with self.lock:
+            self.entries[key] = recipe
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+@st.cache_resource(show_spinner=False)
+def get_recipe_cache():
+    return RecipeCache(RECIPE_CACHE_SIZE)
+
+def format_recipe(recipe_part):
+    return RECIPE_HTML.format(body=STEP_RE.sub(r'<br><br>\1', html.escape(recipe_part.strip())))
+
+def stream_generate(batcher, input_ids, seed, **gen_kwargs):
+    request = batcher.submit(input_ids, seed, **gen_kwargs)
+    try:
+        yield from request.streamer
+    finally:
+        request.cancelled = True
+    if request.error is not None:
+        raise request.error
+
+def compile_torch_model(model, tokenizer):
+    import torch
+
+    # generate() calls self.forward, which a compiled-module wrapper would bypass.
+    eager_forward = model.forward
+    try:
+        import torch._inductor.config as inductor_config
+
+        inductor_config.freezing = True
+        # On CUDA, reduce-overhead would record a CUDA graph for every KV-cache length.
+        mode = "reduce-overhead" if model.device.type == "cpu" else "default"
+        model.forward = torch.compile(eager_forward, mode=mode, dynamic=True)
+        warmup_model(model, tokenizer)
+    except Exception as e:
+        print(f"Warning: torch.compile unavailable, using eager mode. {e}")
+        model.forward = eager_forward
+    return model
+
+def ipex_optimize(model, dtype):
+    try:
+        import intel_extension_for_pytorch as ipex
+    except ImportError:
+        return model
+
+    print("--- Optimizing model with Intel Extension for PyTorch ---")
+    return ipex.optimize(model, dtype=dtype, inplace=True)
+
+def quantize_torch_model(model):
+    import torch
+    from transformers.pytorch_utils import Conv1D
+
+    # quantize_dynamic skips GPT-2's Conv1D projections, so swap them for Linear first.
+    def conv1d_to_linear(module):
+        for name, child in module.named_children():
+            if isinstance(child, Conv1D):
+                in_features, out_features = child.weight.shape
+                linear = torch.nn.Linear(in_features, out_features)
+                linear.weight.data = child.weight.data.t().contiguous()
+                linear.bias.data = child.bias.data
+                setattr(module, name, linear)
+            else:
+                conv1d_to_linear(child)
+
+    conv1d_to_linear(model)
+    if "fbgemm" in torch.backends.quantized.supported_engines:
+        torch.backends.quantized.engine = "fbgemm"
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def export_onnx_model():
+    from optimum.onnxruntime import ORTModelForCausalLM, ORTOptimizer
+    from optimum.onnxruntime.configuration import OptimizationConfig
+
+    if os.path.exists(os.path.join(ONNX_PATH, ONNX_FILE)):
+        print("ONNX model already exists.")
+        return
+
+    print("--- Exporting model to ONNX (with past key values) ---")
+    try:
+        ort_model = ORTModelForCausalLM.from_pretrained(MODEL_PATH, export=True, use_cache=True)
+        ort_model.save_pretrained(ONNX_PATH)
+
+        optimizer = ORTOptimizer.from_pretrained(ort_model)
+        optimizer.optimize(
+            save_dir=ONNX_PATH,
+            optimization_config=OptimizationConfig(optimization_level=2, optimize_for_gpu=False)
+        )
+    except Exception:
+        shutil.rmtree(ONNX_PATH, ignore_errors=True)
+        raise
+    print("--- ONNX export finished ---")
+
+def quantize_onnx_model():
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    if os.path.exists(os.path.join(ONNX_PATH, ONNX_INT8_FILE)):
+        print("Quantized ONNX model already exists.")
+        return
+
+    print("--- Quantizing ONNX model to INT8 ---")
+    int8_path = os.path.join(ONNX_PATH, ONNX_INT8_FILE)
+    try:
+        quantize_dynamic(
+            os.path.join(ONNX_PATH, ONNX_FILE),
+            int8_path,
+            weight_type=QuantType.QInt8,
+            per_channel=True
+        )
+    except Exception:
+        if os.path.exists(int8_path):
+            os.remove(int8_path)
+        raise
+    print("--- ONNX quantization finished ---")
+
+def tensorrt_enabled():
+    # onnxruntime-gpu lists the TensorRT provider even when TensorRT is not installed.
+    if os.environ.get("RECIPE_TENSORRT") != "1":
+        return False
+    try:
+        import tensorrt  # noqa: F401
+    except ImportError as e:
+        print(f"Warning: RECIPE_TENSORRT is set but TensorRT is unavailable ({e}). Using CUDA.")
+        return False
+    return True
+
+def tensorrt_profile_shapes(config, input_names):
+    head_dim = config.n_embd // config.n_head
+
+    def shapes(batch, seq, past):
+        dims = {
+            "input_ids": (batch, seq),
+            "position_ids": (batch, seq),
+            "attention_mask": (batch, min(past + seq, config.n_positions))
+        }
+        for i in range(config.n_layer):
+            for kind in ("key", "value"):
+                dims[f"past_key_values.{i}.{kind}"] = (batch, config.n_head, past, head_dim)
+        return ",".join(f"{name}:{'x'.join(map(str, dim))}" for name, dim in dims.items() if name in input_names)
+
+    return {
+        "trt_profile_min_shapes": shapes(1, 1, 0),
+        "trt_profile_opt_shapes": shapes(MAX_BATCH_SIZE, 1, config.n_positions // 2),
+        "trt_profile_max_shapes": shapes(MAX_BATCH_SIZE, config.n_positions, config.n_positions - 1)
+    }
+
+def load_onnx_model(tokenizer, use_cuda):
+    import onnx
+    import onnxruntime as ort
+    from optimum.onnxruntime import ORTModelForCausalLM
+    from transformers import GPT2Config
+
+    export_onnx_model()
+
+    # GPU hosts can still have the CPU-only onnxruntime wheel.
+    use_cuda = use_cuda and "CUDAExecutionProvider" in ort.get_available_providers()
+    config = GPT2Config.from_pretrained(ONNX_PATH)
+    use_tensorrt = use_cuda and tensorrt_enabled()
+    if use_tensorrt:
+        # TensorRT cannot run ORT's fused contrib ops, so it builds from the plain export.
+        file_name = "model.onnx"
+        graph = onnx.load(os.path.join(ONNX_PATH, file_name), load_external_data=False).graph
+        trt_options = {
+            "trt_fp16_enable": True,
+            "trt_engine_cache_enable": True,
+            "trt_engine_cache_path": os.path.join(ONNX_PATH, "trt_engines"),
+            **tensorrt_profile_shapes(config, {graph_input.name for graph_input in graph.input})
+        }
+        providers = [("TensorrtExecutionProvider", trt_options), "CUDAExecutionProvider"]
+    elif use_cuda:
+        # Dynamic INT8 (MatMulInteger) has no CUDA kernels.
+        file_name, providers = ONNX_FILE, ["CUDAExecutionProvider"]
     else:
-        print("Model folder already exists.")
-        return True
+        quantize_onnx_model()
+        file_name, providers = ONNX_INT8_FILE, ["CPUExecutionProvider"]
 
-model_ready = setup_and_download_model()
+    session_options = ort.SessionOptions()
+    session_options.intra_op_num_threads = NUM_THREADS
+    session_options.inter_op_num_threads = 1
+    session_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+
+    session = ort.InferenceSession(
+        os.path.join(ONNX_PATH, file_name),
+        sess_options=session_options,
+        providers=providers
+    )
+    model = ORTModelForCausalLM(session, config, model_save_dir=ONNX_PATH)
+    if use_tensorrt:
+        warmup_model(model, tokenizer)
+    return model
+
+class CT2CausalLM:
+    """Wraps a ctranslate2.Generator in the subset of the generate() API used by this app."""
+
+    def __init__(self, generator, tokenizer):
+        self.generator = generator
+        self.tokenizer = tokenizer
+
+    def generate(self, input_ids, attention_mask=None, max_new_tokens=150, do_sample=True,
+                 temperature=1.0, top_k=50, repetition_penalty=1.0, no_repeat_ngram_size=0,
+                 streamer=None, stopping_criteria=None, **kwargs):
+        import torch
+
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+
+        def stopped():
+            if stopping_criteria is None:
+                return torch.zeros(len(input_ids), dtype=torch.bool)
+            return torch.as_tensor(stopping_criteria(input_ids, None)).expand(len(input_ids))
+
+        prompts = [
+            self.tokenizer.convert_ids_to_tokens(ids[mask.bool()].tolist())
+            for ids, mask in zip(input_ids, attention_mask)
+        ]
+        options = dict(
+            max_length=max_new_tokens,
+            sampling_temperature=temperature if do_sample else 1.0,
+            sampling_topk=top_k if do_sample else 1,
+            repetition_penalty=repetition_penalty,
+            no_repeat_ngram_size=no_repeat_ngram_size,
+            end_token=self.tokenizer.eos_token
+        )
+        pad_id = self.tokenizer.pad_token_id
+
+        if streamer is not None and len(prompts) == 1:
+            streamer.put(input_ids)
+            new_ids = []
+            for step in self.generator.generate_tokens(prompts[0], **options):
+                new_ids.append(step.token_id)
+                streamer.put(torch.tensor([step.token_id]))
+                if stopped()[0]:
+                    break
+            streamer.end()
+            results = [new_ids]
+        else:
+            results = [
+                result.sequences_ids[0]
+                for result in self.generator.generate_batch(
+                    prompts,
+                    include_prompt_in_result=False,
+                    callback=lambda step: bool(stopped()[step.batch_id]),
+                    **options
+                )
+            ]
+            # generate_tokens takes one prompt, so batch output is replayed into the streamer.
+            if streamer is not None:
+                streamer.put(input_ids)
+                for step in range(max(len(ids) for ids in results)):
+                    streamer.put(torch.tensor([ids[step] if step < len(ids) else pad_id for ids in results]))
+                streamer.end()
+
+        width = max(len(ids) for ids in results)
+        new_ids = torch.tensor([ids + [pad_id] * (width - len(ids)) for ids in results], dtype=input_ids.dtype)
+        return torch.cat([input_ids, new_ids], dim=1)
+
+def convert_ct2_model():
+    from ctranslate2.converters import TransformersConverter
+
+    if os.path.exists(os.path.join(CT2_PATH, "model.bin")):
+        print("CTranslate2 model already exists.")
+        return
+
+    print("--- Converting model to CTranslate2 (INT8) ---")
+    try:
+        TransformersConverter(MODEL_PATH).convert(CT2_PATH, quantization="int8")
+    except Exception:
+        shutil.rmtree(CT2_PATH, ignore_errors=True)
+        raise
+    print("--- CTranslate2 conversion finished ---")
+
+def load_ct2_model(tokenizer):
+    import ctranslate2
+
+    convert_ct2_model()
+    generator = ctranslate2.Generator(
+        CT2_PATH,
+        device="cpu",
+        compute_type="int8",
+        inter_threads=1,
+        intra_threads=NUM_THREADS
+    )
+    return CT2CausalLM(generator, tokenizer)
 
-@st.cache_resource
 def load_model():
+    import torch
+    from transformers import GPT2LMHeadModel, GPT2TokenizerFast
+    from transformers.utils import is_accelerate_available
+
     print("--- Loading model and tokenizer ---")
-    
+
+    use_cuda = torch.cuda.is_available()
+    if use_cuda:
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.benchmark = True
+
+    torch.set_num_threads(NUM_THREADS)
     try:
-        tokenizer = GPT2Tokenizer.from_pretrained(MODEL_PATH)
-        tokenizer.padding_side = 'left'
-        
-        model = GPT2LMHeadModel.from_pretrained(MODEL_PATH)
-        
-        tokenizer.pad_token = tokenizer.eos_token
-        
-        generator_pipeline = pipeline(
-            "text-generation",
-            model=model,
-            tokenizer=tokenizer,
-            device=-1
-        )
-        print("--- Model and tokenizer loaded successfully ---")
-        return generator_pipeline, tokenizer
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set once per process.
+        pass
+
+    tokenizer = GPT2TokenizerFast.from_pretrained(MODEL_PATH)
+    tokenizer.pad_token = tokenizer.eos_token
+
+    model = None
+    if BACKEND == "onnx":
+        try:
+            model = load_onnx_model(tokenizer, use_cuda)
+        except Exception as e:
+            print(f"Warning: ONNX Runtime backend failed to load ({e!r}). Falling back to PyTorch.")
+    elif BACKEND == "ctranslate2":
+        try:
+            model = load_ct2_model(tokenizer)
+        except Exception as e:
+            print(f"Warning: CTranslate2 backend failed to load ({e!r}). Falling back to PyTorch.")
+
+    if model is None:
+        if use_cuda:
+            device, dtype = "cuda", torch.float16
+        elif bf16_supported():
+            device, dtype = "cpu", torch.bfloat16
+        else:
+            device, dtype = "cpu", torch.float32
+
+        load_kwargs = {"torch_dtype": dtype}
+        if is_accelerate_available():
+            load_kwargs["low_cpu_mem_usage"] = True
+            if device == "cuda":
+                load_kwargs["device_map"] = "auto"
+
+        model = GPT2LMHeadModel.from_pretrained(MODEL_PATH, **load_kwargs)
+        if "device_map" not in load_kwargs:
+            model = model.to(device)
+        model.eval()
+        if dtype == torch.float32:
+            model = quantize_torch_model(model)
+        elif device == "cpu":
+            model = ipex_optimize(model, dtype)
+        model = compile_torch_model(model, tokenizer)
+
+    print("--- Model and tokenizer loaded successfully ---")
+    return model, tokenizer
+
+@st.cache_resource(show_spinner=False, ttl=None, max_entries=1)
+def start_model_loading():
+    return ThreadPoolExecutor(max_workers=1).submit(load_model)
+
+def resolve_model(model_loading):
+    if not model_loading.done():
+        with st.spinner("Warming up the AI chef... This may take a moment."):
+            wait([model_loading])
+
+    try:
+        return model_loading.result()
     except Exception as e:
         st.error(f"Error loading model: {e}")
         st.error(f"Please make sure your model files are in a folder named 'final_model' in the same directory as 'app.py'")
         return None, None
 
-generator = None
-tokenizer = None
+model_loading = start_model_loading() if model_ready else None
 
-if model_ready:
-    with st.spinner("Warming up the AI chef... This may take a moment."):
-        generator, tokenizer = load_model()
+if "recipe_variant" not in st.session_state:
+    st.session_state.recipe_variant = 0
 
 st.title("AI Recipe Generator")
 st.caption("Turn your ingredients into a delicious dish with the help of GPT-2.")
@@ -127,53 +617,73 @@ with col1:
             max_tokens = st.slider("Recipe Length (Max Tokens)", min_value=50, max_value=250, value=150, step=10)
 
         submit_button = st.form_submit_button(label="Generate Recipe")
+        regenerate_button = st.form_submit_button(label="Regenerate", help="Get a different recipe for the same inputs.")
 
 with col2:
     st.header("Your AI-Generated Recipe")
     
     output_container = st.container(border=True, height=450)
 
-if submit_button and generator:
+model = None
+tokenizer = None
+
+submitted = submit_button or regenerate_button
+if submitted and model_loading:
+    model, tokenizer = resolve_model(model_loading)
+
+if submitted and model:
     if not title or not ingredients_raw:
         st.error("Please provide both a title and ingredients.")
     else:
         with st.spinner("Generating your recipe..."):
             title_clean = title.strip().lower()
-            ingredients_clean = ", ".join([ing.strip().lower() for ing in ingredients_raw.split(',')])
+            ingredients_clean = ", ".join(ing.strip() for ing in ingredients_raw.lower().split(','))
 
-            prompt = (
-                f"TITLE: {title_clean}\n"
-                f"INGREDIENTS: {ingredients_clean}\n"
-                f"RECIPE:"
-            )
+            if regenerate_button:
+                st.session_state.recipe_variant += 1
+            do_sample = round(temp, 2) > GREEDY_MAX_TEMPERATURE
+            cache_key = (title_clean, ingredients_clean, temp, max_tokens)
+            if do_sample:
+                cache_key += (st.session_state.recipe_variant,)
+            recipe_cache = get_recipe_cache()
 
             try:
-                generated_output = generator(
-                    prompt,
-                    max_new_tokens=max_tokens,
-                    no_repeat_ngram_size=2,
-                    temperature=temp,
-                    top_k=50,
-                    eos_token_id=tokenizer.eos_token_id,
-                    pad_token_id=tokenizer.eos_token_id
-                )
+                with output_container:
+                    st.subheader(title.title())
+                    placeholder = st.empty()
 
-                full_text = generated_output[0]['generated_text']
-                recipe_part = full_text[len(prompt):].strip()
+                recipe_part = recipe_cache.get(cache_key)
+                if recipe_part is None:
+                    input_ids = encode_prompt(tokenizer, title_clean, ingredients_clean)
+                    sampling_kwargs = {"temperature": temp, "top_k": 50} if do_sample else {}
 
-                if tokenizer.eos_token in recipe_part:
-                    recipe_part = recipe_part.split(tokenizer.eos_token)[0]
+                    chunks = stream_generate(
+                        get_batcher(model, tokenizer),
+                        input_ids,
+                        zlib.crc32(repr(cache_key).encode()),
+                        max_new_tokens=max_tokens,
+                        do_sample=do_sample,
+                        repetition_penalty=1.2,
+                        **sampling_kwargs,
+                        eos_token_id=tokenizer.eos_token_id,
+                        pad_token_id=tokenizer.eos_token_id,
+                        use_cache=True
+                    )
 
-                formatted_recipe = re.sub(r' (\d+\.)', r'\n\n\1', recipe_part).strip()
+                    # Streamlit stops a run with a BaseException; closing marks the request cancelled.
+                    with contextlib.closing(chunks):
+                        recipe_part = ""
+                        for chunk in chunks:
+                            recipe_part += chunk
+                            placeholder.html(format_recipe(recipe_part))
+                    recipe_cache.put(cache_key, recipe_part)
 
-                with output_container:
-                    st.subheader(title.title())
-                    st.markdown(formatted_recipe)
+                placeholder.html(format_recipe(recipe_part))
 
             except Exception as e:
                 st.error(f"An error occurred during generation: {e}")
 
-elif not generator and model_ready:
+elif not submitted and model_loading and model_loading.done() and model_loading.exception() is not None:
     st.error("Model is ready but failed to load. Please check the app logs.")
 elif not model_ready:
     st.error("Model download failed. The app cannot function. Please check your Kaggle API secrets and dataset path.")
@@ -0,0 +1,36 @@
+"""Downloads the fine-tuned model from Kaggle.
+
+Run `python fetch_model.py` at image build time (credentials from KAGGLE_USERNAME/KAGGLE_KEY
+or ~/.kaggle/kaggle.json) so serving processes only have to check that the files exist.
+"""
+import os
+
+MODEL_PATH = "final_model"
+KAGGLE_DATASET = "ahmadijaz92/genai-p3-t1"
+LOCK_PATH = MODEL_PATH + ".lock"
+
+def model_present():
+    return os.path.exists(os.path.join(MODEL_PATH, "config.json"))
+
+def fetch_model(username=None, key=None):
+    # POSIX-only; imported here so app.py still imports on Windows.
+    import fcntl
+
+    with open(LOCK_PATH, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if model_present():
+            print("Model folder already exists.")
+            return
+
+        if username and key:
+            os.environ["KAGGLE_USERNAME"] = username
+            os.environ["KAGGLE_KEY"] = key
+
+        import kaggle
+
+        print("Downloading model from Kaggle...")
+        kaggle.api.dataset_download_files(KAGGLE_DATASET, path=".", unzip=True, quiet=False)
+        print("Model downloaded and unzipped successfully.")
+
+if __name__ == "__main__":
+    fetch_model()